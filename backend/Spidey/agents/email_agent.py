@@ -1,95 +1,252 @@
 """
-Email Agent - Uses the exact working pattern from test.py
+Email Agent - LangGraph agent with native tool calling
 """
 
+import asyncio
 import logging
-import os
-from langchain.tools import tool
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.schema import HumanMessage, SystemMessage, AIMessage
+import threading
+import time
+from collections import OrderedDict
+from langchain.schema import SystemMessage, AIMessage
 from langchain_core.messages import ToolMessage
 from langgraph.graph import MessageGraph, END
 
 # Import tools from tools module
-import sys
-import os
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from tools.email_draft_tool import create_email_drafts
 from tools.query_email_threads import query_email_threads
 from tools.fetch_emails_page import fetch_emails_page
-from .model_factory import create_llm_from_key_type
+from .model_factory import create_llm_from_key_type, _key_digest
+
+# google-api-core ships with langchain-google-genai; guard anyway so the agent
+# still works for OpenAI-only installs
+try:
+    from google.api_core import exceptions as gexc
+except ImportError:
+    gexc = None
 
 logger = logging.getLogger(__name__)
 
+# Static system prompt - built once at import time instead of on every model call.
+# Kept deliberately compact: every turn pays for these tokens, so instructions
+# are stated once instead of restated per section.
+SPIDEY_SYSTEM_PROMPT = """Your name is Spidey, an email assistant. Answer greetings and general email guidance directly; use tools only when the task needs them.
+
+Tools:
+- create_email_drafts: use when the user wants emails drafted. Write the subject and body yourself from the user's description. If the recipient email or the purpose is missing, ask a follow-up question. After creating, say the draft was created successfully, point the user to the drafts section, and ask what they want to do next.
+- query_email_threads: use only when the user gives specific thread IDs. Summarize the whole conversation in each thread as easy-to-read insight points, not just subjects and bodies.
+- fetch_emails_page: use when the user asks about their emails, read/unread status, or the current page without giving thread IDs. Summarize with dates (sorted by date for recent-email requests) and report read/unread status thread by thread.
+
+Rules:
+- Never ask the user for a page number or thread ID.
+- Never mention tools, threads, or page numbers to the user.
+"""
+
+
+# One SystemMessage shared by every agent - the prompt is identical for all
+_SYSTEM_MESSAGE = SystemMessage(content=SPIDEY_SYSTEM_PROMPT)
+
+# Tools bound to every agent; name-keyed for O(1) dispatch in call_tools
+_TOOLS = [create_email_drafts, query_email_threads, fetch_emails_page]
+_TOOLS_BY_NAME = {t.name: t for t in _TOOLS}
+
+# Returned verbatim whenever the provider rejects the user's key
+API_KEY_ERROR_MESSAGE = "There is a problem with your API key. Please check it in settings and try again."
+
+# Keys that recently failed auth, as hashed digests mapped to a monotonic
+# expiry. A known-bad key answers immediately with the cached error instead of
+# paying another provider round-trip; the TTL lets a fixed key recover quickly.
+_BAD_KEY_TTL_SECONDS = 60.0
+_bad_keys = {}
+
+
+def _is_known_bad_key(digest: bytes) -> bool:
+    expiry = _bad_keys.get(digest)
+    if expiry is None:
+        return False
+    if time.monotonic() >= expiry:
+        _bad_keys.pop(digest, None)
+        return False
+    return True
+
+
+def _mark_bad_key(digest: bytes) -> None:
+    now = time.monotonic()
+    # Sweep expired digests while we're here; probing only evicts its own
+    # entry, so without this the map would grow with every key seen once
+    for stale in [d for d, expiry in _bad_keys.items() if expiry <= now]:
+        _bad_keys.pop(stale, None)
+    _bad_keys[digest] = now + _BAD_KEY_TTL_SECONDS
+
+
+def _is_retryable_error(e: Exception) -> bool:
+    """
+    Only transient failures (rate limits, 5xx, dropped connections) are worth
+    retrying. Auth and bad-request errors will fail identically every time,
+    so retrying them just wastes round-trips.
+    """
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+
+    # Prefer SDK exception types: isinstance is constant-time and immune to
+    # provider error messages changing wording
+    if gexc is not None:
+        if isinstance(e, (gexc.ResourceExhausted, gexc.ServiceUnavailable,
+                          gexc.InternalServerError, gexc.DeadlineExceeded)):
+            return True
+        if isinstance(e, (gexc.Unauthenticated, gexc.PermissionDenied, gexc.InvalidArgument)):
+            return False
+
+    status = getattr(e, 'status_code', None)
+    if isinstance(status, int):
+        return status in (429, 500, 502, 503, 504)
+
+    msg = str(e)
+    if 'API_KEY_INVALID' in msg or 'PERMISSION_DENIED' in msg or 'INVALID_ARGUMENT' in msg:
+        return False
+    return '429' in msg or 'rate limit' in msg.lower() or 'unavailable' in msg.lower()
+
+
+def _split_thread_results(merged: dict, wanted_ids: list) -> dict:
+    """
+    Carve a per-call slice out of a merged query_email_threads result.
+
+    Returns only the threads whose ids that call asked for; falls back to the
+    full merged payload when the threads cannot be matched (error responses,
+    unexpected shapes).
+    """
+    if not isinstance(merged, dict):
+        return merged
+    threads = merged.get("threads")
+    if not isinstance(threads, list):
+        return merged
+    wanted = set(wanted_ids)
+    matched = [t for t in threads if isinstance(t, dict) and t.get("thread_id") in wanted]
+    if not matched:
+        return merged
+    return {"threads": matched, "total_count": len(matched)}
+
+
+def _is_invalid_argument_error(e: Exception) -> bool:
+    """True when the provider rejected the request shape itself"""
+    if gexc is not None and isinstance(e, gexc.InvalidArgument):
+        return True
+    return 'INVALID_ARGUMENT' in str(e)
+
+
+def _enable_gemini_prompt_cache(llm, api_key: str) -> bool:
+    """
+    Best-effort provider-side caching of the static system prompt.
+
+    Gemini context caching stores the system prompt server-side so it is not
+    re-billed as input tokens on every turn. Not all models/SDK versions
+    support it (small prompts are also rejected), so any failure simply
+    falls back to sending the full prompt per call. Some models also refuse
+    requests that combine cached content with bound tools - call_model
+    detects that at invoke time and drops the cache for the agent.
+    """
+    try:
+        import datetime
+        import google.generativeai as genai
+
+        if not hasattr(llm, 'cached_content'):
+            return False
+
+        genai.configure(api_key=api_key)
+        cache = genai.caching.CachedContent.create(
+            model=llm.model,
+            system_instruction=SPIDEY_SYSTEM_PROMPT,
+            ttl=datetime.timedelta(hours=1)
+        )
+        llm.cached_content = cache.name
+        logger.info(f"Gemini prompt cache enabled: {cache.name}")
+        return True
+    except Exception as e:
+        logger.info(f"Gemini prompt caching unavailable, sending full prompt per turn: {str(e)}")
+        return False
+
+
+# Compiled graphs keyed by credentials/config. Building a graph re-binds the
+# tools and re-negotiates prompt caching, so identical settings share one
+# compiled agent. Graphs are stateless between invocations (conversation state
+# lives in the message list), so sharing is safe. LRU-bounded so graphs
+# evicted by callers' own caches are actually freed instead of living on here.
+_AGENT_CACHE_SIZE = 256
+_agent_cache = OrderedDict()
+_agent_cache_lock = threading.Lock()
+
 
 def create_spidey_agent(api_key: str, key_type: str, **kwargs):
+    key_digest = _key_digest(api_key)
+    cache_key = (key_digest, key_type, kwargs.get('temperature', 0.7), kwargs.get('model_name'))
+    with _agent_cache_lock:
+        cached = _agent_cache.get(cache_key)
+        if cached is not None:
+            _agent_cache.move_to_end(cache_key)
+            return cached
 
     # Create appropriate LLM based on key type
     llm = create_llm_from_key_type(
         api_key=api_key,
         key_type=key_type,
-        temperature=kwargs.get('temperature', 0.7)
+        temperature=kwargs.get('temperature', 0.7),
+        model_name=kwargs.get('model_name')
     )
 
     # Bind all three tools
-    model_with_tools = llm.bind_tools([create_email_drafts, query_email_threads, fetch_emails_page])
-
-    # Define functions  
-    def call_model(messages):
-        
-        content = """Your name is Spidey. You help users create multiple email drafts efficiently. You help users with their email needs.
-
-        TOOLS AVAILABLE(use only when required for greetings, guidance about emails reply directly):
-        - create_email_drafts: Create new email drafts
-        - query_email_threads: Analyze specific email conversations by thread IDs
-        - fetch_emails_page: Fetch and analyze general email summaries from current page
-
-        WHEN TO USE TOOLS:
-        - Use create_email_drafts when user wants to compose or draft emails
-        - Use query_email_threads when user provides specific thread IDs to analyze( when user didnt provide thread id use fetch_emails_page that give complete content)
-        - Use fetch_emails_page when user ask about current page or when users ask about their emails, their read status use this tool, explicity when they didnt use thread ID's
-
-        CREATING DRAFTS:
-        - When user describes his email, create the draft forming in the required format.
-        - Create the subject and body of the email in the way user describes it.
-        - User wont give the subject or body of the email, you need to create them based on the user's description.
-        - if user didnt give recipient email, you need to ask follow up questions to get the recipient email.
-        - if user didnt give the a clear purpose of the email, you need to ask follow up questions to get the purpose of the email.
-        - After creating draft say draft created sucessfully, check it in the draft section and ask what other you want to do.
-
-        QUERY EMAIL THREADS:
-        - When user ask about specific threads, summarize the complete convo in that thread
-        - Dont just provide the subject and body of email, undertand the conversation and provide summary as points , as insights from the conversation.
-        - Provide the summary in a way that is easy to understand 
-
-        FETCH EMAIL PAGE:
-        - Use only when user ask anything about current page without passing the thread id
-        - Summarize the content with date
-        - Provide summary sorted by date when user ask about recent emails
-        - When they ask about read status, call the fetch_emails_page tool and get the read status of emails and provide insights, thread by thread.
-        - When they ask about unread emails, call the fetch_emails_page tool and get the unread emails and provide insights, thread by thread.
-        
-        rules:
-        - Never ask for current page, thread id from the user.
-        - Never ask threadid as follow up questions.
-        - Never always call the tools
-        - Use tools only when required For greetings, guidance about emails reply directly
-        - Never metion about tools , thread or page number to user.
-
-        """
-        system_msg = SystemMessage(content=content)
-        full_messages = [system_msg] + messages
+    model_with_tools = llm.bind_tools(_TOOLS)
 
-        try:
-            response = model_with_tools.invoke(full_messages)
-            logger.info(f"Model response type: {type(response)}")
-            logger.info(f"Has tool_calls: {hasattr(response, 'tool_calls')}")
-            if hasattr(response, 'tool_calls'):
-                logger.info(f"Tool calls: {response.tool_calls}")
-            return response
-        except Exception as e:
-            logger.error(f"Error calling model: {str(e)}", exc_info=True)
-            return AIMessage(content="Error! Please try again later.")
+    # When the provider caches the prompt server-side, don't resend it per turn
+    prompt_cached = _enable_gemini_prompt_cache(llm, api_key) if key_type == "gemini_api_key" else False
+
+    # Define functions
+    async def call_model(messages):
+        nonlocal prompt_cached
+
+        # Keys that just failed auth fail identically for the TTL window;
+        # answer without the provider round-trip
+        if _is_known_bad_key(key_digest):
+            return AIMessage(content=API_KEY_ERROR_MESSAGE)
+
+        if prompt_cached:
+            full_messages = messages
+        else:
+            # Tuple unpack instead of list concat: one allocation, no copy
+            # of the (possibly long) history into a fresh list
+            full_messages = (_SYSTEM_MESSAGE, *messages)
+
+        for attempt in range(3):
+            try:
+                # Native async call so concurrent requests suspend on the event
+                # loop instead of each holding a threadpool worker
+                response = await model_with_tools.ainvoke(full_messages)
+                logger.info(f"Model response type: {type(response)}")
+                logger.info(f"Has tool_calls: {hasattr(response, 'tool_calls')}")
+                if hasattr(response, 'tool_calls'):
+                    logger.info(f"Tool calls: {response.tool_calls}")
+                return response
+            except Exception as e:
+                # Gemini rejects requests that combine cached content with
+                # bound tools; drop the cache for this agent for good and
+                # resend the prompt inline
+                if prompt_cached and _is_invalid_argument_error(e):
+                    logger.warning(f"Cached prompt rejected by provider, sending system prompt inline: {str(e)}")
+                    prompt_cached = False
+                    llm.cached_content = None
+                    full_messages = (_SYSTEM_MESSAGE, *messages)
+                    if attempt < 2:
+                        continue
+                if attempt < 2 and _is_retryable_error(e):
+                    logger.warning(f"Transient model error, retrying (attempt {attempt + 1}): {str(e)}")
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                logger.error(f"Error calling model: {str(e)}", exc_info=True)
+                if gexc is not None and isinstance(e, (gexc.Unauthenticated, gexc.PermissionDenied)):
+                    _mark_bad_key(key_digest)
+                    return AIMessage(content=API_KEY_ERROR_MESSAGE)
+                if 'API_KEY_INVALID' in str(e) or 'PERMISSION_DENIED' in str(e):
+                    _mark_bad_key(key_digest)
+                    return AIMessage(content=API_KEY_ERROR_MESSAGE)
+                return AIMessage(content="Error! Please try again later.")
     
     def route(messages):
         last_message = messages[-1]
@@ -97,43 +254,81 @@ def create_spidey_agent(api_key: str, key_type: str, **kwargs):
             return "tools"
         return END
     
-    def call_tools(messages):
+    def parse_tool_call(i, tool_call):
+        # Handle different tool_call formats
+        if isinstance(tool_call, dict):
+            tool_name = tool_call.get("name")
+            tool_args = tool_call.get("args", {})
+            tool_id = tool_call.get("id")
+        else:
+            # If tool_call is an object with attributes
+            tool_name = getattr(tool_call, 'name', None)
+            tool_args = getattr(tool_call, 'args', {})
+            tool_id = getattr(tool_call, 'id', None)
+        # Only build the fallback id when the provider omitted one
+        return tool_name, tool_args, tool_id or f"call_{i}"
+
+    async def run_tool_call(tool_name, tool_args, tool_id):
+        logger.info(f"Processing tool call: {tool_name} with args: {tool_args}")
+
+        try:
+            tool = _TOOLS_BY_NAME.get(tool_name)
+            if tool is None:
+                logger.warning(f"Unknown tool: {tool_name}")
+                return {"error": f"Unknown tool: {tool_name}"}, tool_id
+            # ainvoke runs the sync tool on a worker thread, so when the
+            # model requests several tools their HTTP calls overlap
+            result = await tool.ainvoke(tool_args)
+            return result, tool_id
+        except Exception as e:
+            logger.error(f"Error executing tool: {str(e)}", exc_info=True)
+            return {"error": str(e)}, tool_id
+
+    async def call_tools(messages):
         last_message = messages[-1]
         tool_calls = last_message.tool_calls
-        
-        results = []
-        for i, tool_call in enumerate(tool_calls):
-            try:
-                # Handle different tool_call formats
-                if isinstance(tool_call, dict):
-                    tool_name = tool_call.get("name")
-                    tool_args = tool_call.get("args", {})
-                    tool_id = tool_call.get("id", f"call_{i}")
-                else:
-                    # If tool_call is an object with attributes
-                    tool_name = getattr(tool_call, 'name', None)
-                    tool_args = getattr(tool_call, 'args', {})
-                    tool_id = getattr(tool_call, 'id', f"call_{i}")
-                
-                logger.info(f"Processing tool call: {tool_name} with args: {tool_args}")
-                
-                if tool_name == "create_email_drafts":
-                    result = create_email_drafts.invoke(tool_args)
-                    results.append((result, tool_id))
-                elif tool_name == "query_email_threads":
-                    result = query_email_threads.invoke(tool_args)
-                    results.append((result, tool_id))
-                elif tool_name == "fetch_emails_page":
-                    result = fetch_emails_page.invoke(tool_args)
-                    results.append((result, tool_id))
-                else:
-                    logger.warning(f"Unknown tool: {tool_name}")
-                    results.append(({"error": f"Unknown tool: {tool_name}"}, tool_id))
-                    
-            except Exception as e:
-                logger.error(f"Error executing tool: {str(e)}", exc_info=True)
-                results.append(({"error": str(e)}, f"call_{i}"))
-        
+
+        calls = [parse_tool_call(i, tool_call) for i, tool_call in enumerate(tool_calls)]
+
+        # Coalesce duplicate thread lookups: when the model requests
+        # query_email_threads several times for the same user, fetch all
+        # thread ids in one backend call and split the threads back out
+        # per original tool_call_id.
+        query_groups = {}
+        for idx, (tool_name, tool_args, _) in enumerate(calls):
+            if tool_name == "query_email_threads" and isinstance(tool_args, dict):
+                query_groups.setdefault(tool_args.get("user_email"), []).append(idx)
+
+        merged_groups = [
+            idxs for user_email, idxs in query_groups.items()
+            if user_email is not None and len(idxs) > 1
+        ]
+        merged_idx = {idx for idxs in merged_groups for idx in idxs}
+
+        plain = [call for idx, call in enumerate(calls) if idx not in merged_idx]
+        coros = [run_tool_call(*call) for call in plain]
+        for idxs in merged_groups:
+            merged_ids = []
+            for idx in idxs:
+                for thread_id in calls[idx][1].get("thread_ids") or []:
+                    if thread_id not in merged_ids:
+                        merged_ids.append(thread_id)
+            merged_args = {
+                "user_email": calls[idxs[0]][1].get("user_email"),
+                "thread_ids": merged_ids,
+            }
+            coros.append(run_tool_call("query_email_threads", merged_args, calls[idxs[0]][2]))
+
+        # Execute all requested tool calls concurrently
+        gathered = await asyncio.gather(*coros)
+
+        results = list(gathered[:len(plain)])
+        for group_pos, idxs in enumerate(merged_groups):
+            merged_result, _ = gathered[len(plain) + group_pos]
+            for idx in idxs:
+                wanted = calls[idx][1].get("thread_ids") or []
+                results.append((_split_thread_results(merged_result, wanted), calls[idx][2]))
+
         # Return tool results as messages
         tool_messages = [
             ToolMessage(content=str(result), tool_call_id=tool_id)
@@ -141,7 +336,7 @@ def create_spidey_agent(api_key: str, key_type: str, **kwargs):
         ]
         return tool_messages
     
-    # Build the graph - exact from test.py
+    # Build the graph
     workflow = MessageGraph()
     
     workflow.add_node("agent", call_model)
@@ -153,9 +348,14 @@ def create_spidey_agent(api_key: str, key_type: str, **kwargs):
     workflow.add_edge("tools", "agent")
     
     graph = workflow.compile()
-    
+
     logger.info(f"Spidey Agent created with {key_type}")
-    
+
+    with _agent_cache_lock:
+        _agent_cache[cache_key] = graph
+        _agent_cache.move_to_end(cache_key)
+        while len(_agent_cache) > _AGENT_CACHE_SIZE:
+            _agent_cache.popitem(last=False)
     return graph
 
 
@@ -2,26 +2,55 @@
 Model Factory - Creates LLM instances for different providers (Gemini, DeepSeek via OpenRouter)
 """
 
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict
 from typing import Optional
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_openai import ChatOpenAI
 
 logger = logging.getLogger(__name__)
 
 
-def create_gemini_model(api_key: str, model_name: str = "gemini-1.5-flash", temperature: float = 0.7):
+def _key_digest(api_key: str) -> bytes:
+    """Hash the key so raw key material never sits in cache keys"""
+    return hashlib.blake2b(api_key.encode(), digest_size=16).digest()
+
+# Shared LLM clients keyed by credentials/config. Constructing a client per
+# call re-opens HTTP connections and re-reads config; identical credentials
+# can share one instance. The lock ensures concurrent first requests for the
+# same key end up sharing a single client instead of each storing their own.
+# LRU-bounded so a worker serving many users doesn't hold one client per
+# credential set forever.
+_LLM_CACHE_SIZE = 256
+_llm_cache = OrderedDict()
+_llm_cache_lock = threading.Lock()
+
+# Circuit breaker for the Gemini fallback loop: a model whose constructor
+# keeps failing (renamed model, kwargs the pinned SDK rejects) is skipped for
+# a cooldown window instead of re-failing on every cold request.
+# model name -> (consecutive_failures, open_until monotonic timestamp)
+_model_failures = {}
+_MODEL_FAILURE_THRESHOLD = 3
+_MODEL_COOLDOWN_SECONDS = 60.0
+
+
+def create_gemini_model(api_key: str, model_name: Optional[str] = None, temperature: float = 0.7):
     """
     Create a Gemini LLM instance with fallback models.
 
     Args:
         api_key: Gemini API key
-        model_name: Primary model name
+        model_name: Primary model name (candidate-list default when None)
         temperature: Response temperature
 
     Returns:
         ChatGoogleGenerativeAI instance
     """
+    # Imported lazily so startup only pays for the provider SDK actually in
+    # use; after the first call this is a sys.modules lookup
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
     # Use more stable models, starting with proven ones
     model_names = [
         'gemini-2.5-flash-lite',
@@ -30,7 +59,17 @@ def create_gemini_model(api_key: str, model_name: str = "gemini-1.5-flash", temp
         'gemini-1.0-pro',    # Very stable fallback
     ]
 
+    # Try an explicitly requested model first, keeping the rest as fallbacks;
+    # with no request the proven candidate order stands
+    if model_name and model_name != model_names[0]:
+        model_names = [model_name] + [m for m in model_names if m != model_name]
+
+    now = time.monotonic()
     for model in model_names:
+        failures, open_until = _model_failures.get(model, (0, 0.0))
+        if open_until > now:
+            logger.info(f"Skipping Gemini model {model}: circuit open after repeated failures")
+            continue
         try:
             llm = ChatGoogleGenerativeAI(
                 model=model,
@@ -42,10 +81,14 @@ def create_gemini_model(api_key: str, model_name: str = "gemini-1.5-flash", temp
                 # Disable streaming to avoid response parsing issues
                 streaming=False
             )
-            logger.info(f"✅ Successfully initialized Gemini model: {model}")
+            _model_failures.pop(model, None)
+            logger.info(f"Successfully initialized Gemini model: {model}")
             return llm
         except Exception as e:
-            logger.warning(f"⚠️ Failed to initialize Gemini model {model}: {str(e)}")
+            failures += 1
+            open_until = now + _MODEL_COOLDOWN_SECONDS if failures >= _MODEL_FAILURE_THRESHOLD else 0.0
+            _model_failures[model] = (failures, open_until)
+            logger.warning(f"Failed to initialize Gemini model {model}: {str(e)}")
             continue
 
     # Final fallback - should always work
@@ -72,45 +115,77 @@ def create_openai_model(api_key: str, model_name: str = "gpt-4.1-mini", temperat
     Returns:
         ChatOpenAI instance configured for OpenAI
     """
+    # Imported lazily so startup only pays for the provider SDK actually in
+    # use; after the first call this is a sys.modules lookup
+    from langchain_openai import ChatOpenAI
+
     try:
         llm = ChatOpenAI(
             model=model_name,
             openai_api_key=api_key,
-            temperature=temperature
+            temperature=temperature,
+            # Bound each attempt; the agent's own retry loop handles transient
+            # failures, so don't stack SDK retries on top
+            timeout=60,
+            max_retries=0
         )
-        logger.info(f"✅ Successfully initialized OpenAI model: {model_name}")
+        logger.info(f"Successfully initialized OpenAI model: {model_name}")
         return llm
     except Exception as e:
-        logger.error(f"❌ Failed to initialize OpenAI model: {str(e)}")
+        logger.error(f"Failed to initialize OpenAI model: {str(e)}")
         raise
 
 
 def create_llm_from_key_type(
     api_key: str,
     key_type: str,
-    temperature: float = 0.7
+    temperature: float = 0.7,
+    model_name: Optional[str] = None
 ):
     """
     Create appropriate LLM based on key type.
-    
+
     Args:
         api_key: API key for the provider
         key_type: Type of key ('gemini_api_key' or 'open_ai_key')
         temperature: Response temperature
-        
+        model_name: Optional model override (provider default when None)
+
     Returns:
         LLM instance (ChatGoogleGenerativeAI or ChatOpenAI)
-        
+
     Raises:
         ValueError: If key_type is not supported
     """
+    cache_key = (_key_digest(api_key), key_type, temperature, model_name)
+    with _llm_cache_lock:
+        llm = _llm_cache.get(cache_key)
+        if llm is not None:
+            _llm_cache.move_to_end(cache_key)
+            return llm
+
     if key_type == "gemini_api_key":
-        return create_gemini_model(api_key, temperature=temperature)
+        if model_name:
+            llm = create_gemini_model(api_key, model_name=model_name, temperature=temperature)
+        else:
+            llm = create_gemini_model(api_key, temperature=temperature)
     elif key_type == "open_ai_key":
-        return create_openai_model(api_key, temperature=temperature)
+        if model_name:
+            llm = create_openai_model(api_key, model_name=model_name, temperature=temperature)
+        else:
+            llm = create_openai_model(api_key, temperature=temperature)
     else:
         raise ValueError(f"Unsupported key type: {key_type}. Supported types: 'gemini_api_key', 'open_ai_key'")
 
+    # setdefault under the lock: if another thread built the same client
+    # concurrently, everyone keeps the first one stored
+    with _llm_cache_lock:
+        llm = _llm_cache.setdefault(cache_key, llm)
+        _llm_cache.move_to_end(cache_key)
+        while len(_llm_cache) > _LLM_CACHE_SIZE:
+            _llm_cache.popitem(last=False)
+        return llm
+
 
 __all__ = ['create_gemini_model', 'create_openai_model', 'create_llm_from_key_type']
 
@@ -1,19 +1,34 @@
 #!/usr/bin/env python3
 """
 Spidey MCP Server - Email Automation Agent
-Uses the exact working pattern from test.py with FastAPI and Firestore integration
+FastAPI server around the LangGraph email agent with Firestore integration
 """
 
+import asyncio
+import hashlib
+import json
 import logging
+import re
+import threading
+from collections import OrderedDict
 from typing import Optional, List
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
+
+# orjson-backed responses when available (it is in requirements); plain JSON otherwise
+try:
+    import orjson  # noqa: F401 - presence check for ORJSONResponse
+    from fastapi.responses import ORJSONResponse as _DefaultResponse
+except ImportError:
+    from fastapi.responses import JSONResponse as _DefaultResponse
+
 from pydantic import BaseModel, Field
-import uvicorn
 from dotenv import load_dotenv
 import os
-from langchain.schema import HumanMessage
+from langchain.schema import HumanMessage, AIMessage
 
 # Import agent and utilities
 from agents import create_spidey_agent
@@ -37,31 +52,69 @@ try:
 except Exception as e:
     logger.warning(f"Firestore initialization skipped: {str(e)}")
 
+# Optional LangChain-level LLM response cache: exact-repeat prompts (retries,
+# duplicate frontend submissions) skip the provider round-trip entirely.
+# Opt-in via env because responses are sampled at temperature 0.7.
+# Set SPIDEY_CACHE_DB to a file path to persist the cache across restarts.
+if os.getenv("SPIDEY_LLM_CACHE", "0") == "1":
+    try:
+        from langchain.globals import set_llm_cache
+        cache_db = os.getenv("SPIDEY_CACHE_DB")
+        if cache_db:
+            from langchain_community.cache import SQLiteCache
+            set_llm_cache(SQLiteCache(database_path=cache_db))
+            logger.info(f"LangChain LLM response cache enabled (SQLite: {cache_db})")
+        else:
+            from langchain_community.cache import InMemoryCache
+            set_llm_cache(InMemoryCache())
+            logger.info("LangChain LLM response cache enabled (in-memory)")
+    except Exception as e:
+        logger.warning(f"Could not enable LLM response cache: {str(e)}")
+
 # FastAPI app
 app = FastAPI(
-    title="Spidey MCP Server", 
-    version="3.1.0", 
-    description="Email Automation Agent"
+    title="Spidey MCP Server",
+    version="3.1.0",
+    description="Email Automation Agent",
+    default_response_class=_DefaultResponse
 )
 
-# CORS middleware
+# CORS middleware. No wildcard origin: browsers reject "*" together with
+# allow_credentials=True anyway, and the explicit list keeps preflight
+# responses cacheable.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:5000", "https://superspidey-contact-remedy.onrender.com", "*"],
+    allow_origins=["http://localhost:5000", "https://superspidey-contact-remedy.onrender.com"],
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
 )
 
+# Compress larger JSON payloads (multi-draft summaries reach tens of KB);
+# small responses skip compression to avoid the CPU cost. The SSE stream is
+# exempt: gzip buffers frames until the stream closes, which would defeat
+# incremental delivery.
+class _SelectiveGZipMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/invoke/stream":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(_SelectiveGZipMiddleware, minimum_size=500)
+
 
 # Request/Response Models
 class SpideyRequest(BaseModel):
     """Request model for Spidey agent"""
-    user_email: str = Field(..., description="User's email address")
-    task: str = Field(..., description="Task description")
+    user_email: str = Field(..., min_length=3, max_length=320, description="User's email address")
+    # No max_length on task/previous_convo: the frontend grows history without
+    # trimming, so oversize text is truncated by sanitize_input, not rejected
+    task: str = Field(..., min_length=1, description="Task description")
     previous_convo: Optional[str] = Field(None, description="Previous conversation history")
     thread_ids: Optional[List[str]] = Field(None, description="Thread IDs to query (for conversation analysis)")
-    page: Optional[int] = Field(1, description="Page number for email fetching (default: 1)")
+    page: Optional[int] = Field(1, ge=1, description="Page number for email fetching (default: 1)")
 
 
 class SpideyResponse(BaseModel):
@@ -71,30 +124,131 @@ class SpideyResponse(BaseModel):
     action_taken: Optional[str] = None
 
 
-# Agent cache
-agent_cache = {}
+# Keyword classification - compiled/built once so each request does a single
+# tokenization pass plus set intersections instead of N substring scans
+_WORD_RE = re.compile(r'[a-z]+')
+_SUMMARY_KEYWORDS = frozenset({
+    'summarize', 'summary', 'recent', 'emails', 'sent', 'received', 'unread', 'view', 'show'
+})
+
+# Only the most recent messages are replayed to the model; without a window
+# the prompt (and token cost) grows linearly with conversation age
+_HISTORY_WINDOW = 12
+
+# Single-pass parser for 'User: ...'/'Spidey: ...' history. One C-level scan
+# instead of a Python loop with per-line startswith checks; the lookahead also
+# keeps it working after sanitize_input collapses newlines to spaces.
+_HISTORY_RE = re.compile(r'(User|Spidey): (.*?)\s*(?=User: |Spidey: |$)', re.DOTALL)
 
+# Model routing: greetings and quick questions go to the lite model, draft
+# writing and summarization (or very long tasks) to the larger one
+_LARGE_MODEL_KEYWORDS = frozenset({
+    'create', 'write', 'draft', 'compose', 'generate', 'make'
+}) | _SUMMARY_KEYWORDS
+_SMALL_MODEL = 'gemini-2.5-flash-lite'
+_LARGE_MODEL = 'gemini-2.5-flash'
 
-def get_or_create_agent(api_key: str, key_type: str, user_email: str):
+
+# Static instruction templates appended to the user message - the constant
+# text is assembled once at import, the hot path only fills the dynamic slots
+_THREAD_CONTEXT_TMPL = (
+    "{task}\n\n[Please analyze these specific email threads: {thread_ids}. "
+    "Use the query_email_threads tool to get the conversation data first, "
+    "then answer my question about them.]"
+)
+_PAGE_CONTEXT_TMPL = (
+    "{task}\n\n[This appears to be a general email summarization request. "
+    "Use the fetch_emails_page tool with page {page} to get the current page of emails, "
+    "then summarize or answer the user's question about their emails.]"
+)
+_USER_CONTEXT_TMPL = "{task}\n\n[User email: {user_email}, Current page: {page}]"
+
+# Pure greetings and a few fixed chit-chat turns are answered locally - a
+# network LLM round-trip for "hi" or "thanks" costs seconds of latency for
+# what is effectively a fixed response
+_CANNED_GREETING = (
+    "Hi! I'm Spidey, your email assistant. I can draft emails for you, "
+    "summarize your inbox, and analyze specific email conversations. "
+    "What would you like to do?"
+)
+_CANNED_THANKS = "You're welcome! Anything else I can help you with?"
+_CANNED_BYE = "Goodbye! Come back whenever you need help with your emails."
+_CANNED_RESPONSES = {
+    'hi': _CANNED_GREETING,
+    'hello': _CANNED_GREETING,
+    'hey': _CANNED_GREETING,
+    'yo': _CANNED_GREETING,
+    'hola': _CANNED_GREETING,
+    'who are you': _CANNED_GREETING,
+    'what can you do': _CANNED_GREETING,
+    'help': _CANNED_GREETING,
+    'thanks': _CANNED_THANKS,
+    'thank you': _CANNED_THANKS,
+    'bye': _CANNED_BYE,
+    'goodbye': _CANNED_BYE,
+}
+
+
+def _select_model_name(task: str, task_words: frozenset) -> str:
+    """Pick the Gemini model tier for a task based on its complexity"""
+    if len(task) > 2000 or not _LARGE_MODEL_KEYWORDS.isdisjoint(task_words):
+        return _LARGE_MODEL
+    return _SMALL_MODEL
+
+# Agent cache, LRU-bounded so long-lived workers don't accumulate one agent
+# per (user key, model) pair forever. Mutations are locked; reads go through
+# the lock too since move_to_end reorders the dict.
+_AGENT_CACHE_SIZE = int(os.getenv("AGENT_CACHE_SIZE", 256))
+agent_cache = OrderedDict()
+_agent_cache_lock = threading.Lock()
+
+# Exact-match response cache for read-only conversational turns. Keyed on the
+# raw (user, task, history) triple; turns that create drafts or refetch email
+# state bypass it entirely.
+_RESPONSE_CACHE_SIZE = 256
+_response_cache = OrderedDict()
+
+
+def _response_cache_get(key):
+    """Return a cached response text and refresh its LRU position"""
+    text = _response_cache.get(key)
+    if text is not None:
+        _response_cache.move_to_end(key)
+    return text
+
+
+def _response_cache_put(key, text):
+    """Store a response text, evicting the least recently used entry"""
+    _response_cache[key] = text
+    _response_cache.move_to_end(key)
+    while len(_response_cache) > _RESPONSE_CACHE_SIZE:
+        _response_cache.popitem(last=False)
+
+
+def get_or_create_agent(api_key: str, key_type: str, user_email: str, model_name: Optional[str] = None):
     """Get existing agent from cache or create new one"""
-    cache_key = hash(f"{api_key}_{key_type}")
-    
-    if cache_key in agent_cache:
-        logger.info(f"Using cached agent for user: {user_email}")
-        return agent_cache[cache_key]
-    
+    # blake2b digest rather than hash(): stable across restarts, collision
+    # resistant across tenants, and keeps raw key material out of the cache
+    cache_key = hashlib.blake2b(
+        f"{key_type}:{api_key}:{model_name}".encode(), digest_size=16
+    ).digest()
+
+    with _agent_cache_lock:
+        agent = agent_cache.get(cache_key)
+        if agent is not None:
+            agent_cache.move_to_end(cache_key)
+            logger.info(f"Using cached agent for user: {user_email}")
+            return agent
+
     logger.info(f"Creating new agent for user: {user_email}")
-    
+
     try:
         agent = create_spidey_agent(
             api_key=api_key,
             key_type=key_type,
-            temperature=0.7
+            temperature=0.7,
+            model_name=model_name
         )
-        
-        agent_cache[cache_key] = agent
-        return agent
-        
     except Exception as e:
         logger.error(f"Failed to create agent: {str(e)}")
         raise HTTPException(
@@ -102,112 +256,201 @@ def get_or_create_agent(api_key: str, key_type: str, user_email: str):
             detail=f"Failed to initialize agent: {str(e)}"
         )
 
+    with _agent_cache_lock:
+        agent_cache[cache_key] = agent
+        agent_cache.move_to_end(cache_key)
+        while len(agent_cache) > _AGENT_CACHE_SIZE:
+            agent_cache.popitem(last=False)
+    return agent
+
+
+def _warmup_provider():
+    """Build a throwaway Gemini client so the lazily imported SDK and the
+    factory's fallback loop are warm before the first real request"""
+    try:
+        from agents.model_factory import create_gemini_model
+        create_gemini_model(os.environ["SPIDEY_WARMUP_KEY"])
+        logger.info("Provider warmup complete")
+    except Exception as e:
+        logger.warning(f"Provider warmup failed: {str(e)}")
+
+
+@app.on_event("startup")
+async def warmup():
+    """Optional background warmup; set SPIDEY_WARMUP_KEY to enable"""
+    if os.getenv("SPIDEY_WARMUP_KEY"):
+        # Run off the event loop and don't block startup on it
+        asyncio.get_event_loop().run_in_executor(None, _warmup_provider)
+
+
+# Static service-info payloads, serialized once at import. Liveness probes
+# hit these endpoints constantly; re-encoding the same dict per hit is waste.
+_ROOT_BYTES = json.dumps({
+    "agent": "Spidey",
+    "version": "3.1.0",
+    "description": "Email Automation Agent",
+    "status": "operational"
+}).encode()
+_HEALTH_BYTES = json.dumps({
+    "status": "healthy",
+    "agent": "Spidey",
+    "version": "3.1.0"
+}).encode()
+
 
 @app.get("/")
 async def root():
     """Root endpoint"""
-    return {
-        "agent": "Spidey",
-        "version": "3.1.0",
-        "description": "Email Automation Agent",
-        "status": "operational"
-    }
+    return Response(content=_ROOT_BYTES, media_type="application/json")
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "agent": "Spidey",
-        "version": "3.1.0"
-    }
+    return Response(content=_HEALTH_BYTES, media_type="application/json")
+
+
+def _prepare_invocation(request: SpideyRequest):
+    """
+    Validate a request and build the agent plus message list.
+
+    Shared by /invoke and /invoke/stream. Returns (agent, messages, canned)
+    where a non-None canned text should be returned directly without
+    touching the agent (e.g. for bare greetings).
+    """
+    logger.info(f"Received request from user: {request.user_email}")
+
+    # Validate email
+    if not validate_email(request.user_email):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid user email address"
+        )
+
+    # Fetch the user's selected API key and key type from Firestore
+    try:
+        api_key = get_user_api_key(request.user_email)
+        key_type = get_user_selected_key(request.user_email)
+        logger.info(f"Successfully fetched selected {key_type} for user: {request.user_email}")
+    except ValueError as e:
+        raise HTTPException(
+            status_code=404,
+            detail=str(e)
+        )
+    except Exception as e:
+        logger.error(f"Error fetching API key: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to fetch API key: {str(e)}"
+        )
+
+    # Sanitize input
+    task = sanitize_input(request.task, max_length=5000)
+    previous_convo = sanitize_input(request.previous_convo or "", max_length=10000)
+
+    if not task:
+        raise HTTPException(
+            status_code=400,
+            detail="Task cannot be empty"
+        )
+
+    # Lowercase and tokenize the task once; every classification below
+    # (greeting, model tier, summarization intent) reuses these
+    task_lower = task.lower()
+    task_words = frozenset(_WORD_RE.findall(task_lower))
+
+    # Answer pure greetings and fixed chit-chat locally without an LLM round-trip
+    canned = _CANNED_RESPONSES.get(task_lower.strip('!?. '))
+    if canned is not None and not request.thread_ids:
+        return None, [], canned
+
+    # Get or create agent, routing simple turns to the cheaper model
+    model_name = _select_model_name(task, task_words) if key_type == "gemini_api_key" else None
+    agent = get_or_create_agent(api_key, key_type, request.user_email, model_name)
+
+    # Build messages
+    messages = []
+
+    # Add previous conversation if exists, keeping only the tail window
+    if previous_convo:
+        history = [
+            HumanMessage(content=content) if role == 'User' else AIMessage(content=content)
+            for role, content in _HISTORY_RE.findall(previous_convo)
+        ]
+        messages.extend(history[-_HISTORY_WINDOW:])
+
+    # Build current message
+    current_message = task
+
+    # Add context based on what's being asked
+    if request.thread_ids and len(request.thread_ids) > 0:
+        # Specific thread analysis
+        current_message = _THREAD_CONTEXT_TMPL.format(task=current_message, thread_ids=', '.join(request.thread_ids))
+    elif not _SUMMARY_KEYWORDS.isdisjoint(task_words):
+        # General email summarization - use page fetching
+        current_message = _PAGE_CONTEXT_TMPL.format(task=current_message, page=request.page)
+
+    # Add user email and page info to message for tool execution
+    current_message = _USER_CONTEXT_TMPL.format(task=current_message, user_email=request.user_email, page=request.page)
+    messages.append(HumanMessage(content=current_message))
+
+    logger.info(f"Invoking agent with task: {task[:100]}...")
+    return agent, messages, None
+
+
+def _sse_event(payload: dict) -> str:
+    """Format a payload as a Server-Sent Events data frame"""
+    return f"data: {json.dumps(payload)}\n\n"
 
 
 @app.post("/invoke", response_model=SpideyResponse)
 async def invoke_spidey(request: SpideyRequest):
     """
     Invoke Spidey agent to process user requests.
-    Uses the exact working pattern from test.py
     """
     try:
-        logger.info(f"Received request from user: {request.user_email}")
-        
-        # Validate email
-        if not validate_email(request.user_email):
-            raise HTTPException(
-                status_code=400,
-                detail="Invalid user email address"
+        agent, messages, canned = _prepare_invocation(request)
+        if canned is not None:
+            return SpideyResponse(
+                success=True,
+                message=canned,
+                action_taken="direct_response"
             )
 
-        # Fetch the user's selected API key and key type from Firestore
-        try:
-            api_key = get_user_api_key(request.user_email)
-            key_type = get_user_selected_key(request.user_email)
-            logger.info(f"Successfully fetched selected {key_type} for user: {request.user_email}")
-        except ValueError as e:
-            raise HTTPException(
-                status_code=404,
-                detail=str(e)
-            )
-        except Exception as e:
-            logger.error(f"Error fetching API key: {str(e)}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to fetch API key: {str(e)}"
-            )
-        
-        # Sanitize input
-        task = sanitize_input(request.task, max_length=5000)
-        previous_convo = sanitize_input(request.previous_convo or "", max_length=10000)
-        
-        if not task:
-            raise HTTPException(
-                status_code=400,
-                detail="Task cannot be empty"
-            )
-        
-        # Get or create agent
-        agent = get_or_create_agent(api_key, key_type, request.user_email)
-        
-        # Build messages - exact pattern from test.py
-        messages = []
-        
-        # Add previous conversation if exists
-        if previous_convo:
-            for line in previous_convo.split('\n'):
-                if line.startswith('User: '):
-                    messages.append(HumanMessage(content=line[6:]))
-                elif line.startswith('Spidey: '):
-                    from langchain.schema import AIMessage
-                    messages.append(AIMessage(content=line[8:]))
-        
-        # Build current message
-        current_message = task
-
-        # Add context based on what's being asked
-        if request.thread_ids and len(request.thread_ids) > 0:
-            # Specific thread analysis
-            current_message = f"{current_message}\n\n[Please analyze these specific email threads: {', '.join(request.thread_ids)}. Use the query_email_threads tool to get the conversation data first, then answer my question about them.]"
-        elif any(keyword in task.lower() for keyword in ['summarize', 'summary', 'recent', 'emails', 'sent', 'received', 'unread', 'view', 'show me']):
-            # General email summarization - use page fetching
-            current_message = f"{current_message}\n\n[This appears to be a general email summarization request. Use the fetch_emails_page tool with page {request.page} to get the current page of emails, then summarize or answer the user's question about their emails.]"
-
-        # Add user email and page info to message for tool execution
-        current_message = f"{current_message}\n\n[User email: {request.user_email}, Current page: {request.page}]"
-        messages.append(HumanMessage(content=current_message))
-        
-        # Invoke the agent - exact from test.py
-        logger.info(f"Invoking agent with task: {task[:100]}...")
-        result = agent.invoke(messages)
-        
-        # Extract response
+        # Serve repeated read-only turns from the response cache; anything
+        # that looks like it will touch tools skips caching
+        cacheable = (
+            not request.thread_ids
+            and _LARGE_MODEL_KEYWORDS.isdisjoint(_WORD_RE.findall(request.task.lower()))
+        )
+        cache_key = (request.user_email, request.task, request.previous_convo or "") if cacheable else None
+        if cache_key is not None:
+            cached = _response_cache_get(cache_key)
+            if cached is not None:
+                logger.info(f"Response cache hit for user: {request.user_email}")
+                return SpideyResponse(
+                    success=True,
+                    message=cached,
+                    action_taken="direct_response"
+                )
+
+        # Invoke the agent without blocking the event loop, so independent
+        # requests (each potentially creating several drafts) run concurrently
+        result = await agent.ainvoke(messages)
+
+        # Extract response; empty content stays empty rather than leaking the
+        # message repr to the user
         final_message = result[-1]
-        response_text = final_message.content if hasattr(final_message, 'content') else str(final_message)
-        
+        content = getattr(final_message, 'content', None)
+        response_text = content if content is not None else str(final_message)
+
         # Check if tools were used
-        tool_used = any(hasattr(msg, 'tool_calls') and msg.tool_calls for msg in result)
-        
+        tool_used = any(getattr(msg, 'tool_calls', None) for msg in result)
+
+        # Only tool-free answers are safe to replay later
+        if cache_key is not None and not tool_used and response_text:
+            _response_cache_put(cache_key, response_text)
+
         return SpideyResponse(
             success=True,
             message=response_text,
@@ -225,15 +468,64 @@ async def invoke_spidey(request: SpideyRequest):
         )
 
 
+@app.post("/invoke/stream")
+async def invoke_spidey_stream(request: SpideyRequest):
+    """
+    Invoke Spidey agent and stream the response as Server-Sent Events.
+    Clients see each agent step as soon as it completes instead of
+    waiting for the full run to finish.
+    """
+    agent, messages, canned = _prepare_invocation(request)
+
+    async def event_stream():
+        if canned is not None:
+            yield _sse_event({"text": canned})
+            yield _sse_event({"done": True})
+            return
+
+        try:
+            async for update in agent.astream(messages):
+                # Each update maps node name -> emitted message(s)
+                outputs = update.values() if isinstance(update, dict) else [update]
+                for output in outputs:
+                    for msg in output if isinstance(output, list) else [output]:
+                        if isinstance(msg, AIMessage) and msg.content and not getattr(msg, 'tool_calls', None):
+                            yield _sse_event({"text": msg.content})
+            yield _sse_event({"done": True})
+        except Exception as e:
+            logger.error(f"Error in invoke_spidey_stream: {str(e)}")
+            yield _sse_event({"error": "Oops! Something went wrong. Please try again."})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    )
+
+
 if __name__ == "__main__":
+    # Only needed when running the dev server directly; production workers
+    # import main:app without paying for this
+    import sys
+    import uvicorn
+
     port = int(os.getenv("PORT", 8004))
     logger.info(f"Starting Spidey MCP Server on port {port}")
-    
+
+    # uvloop/httptools (from uvicorn[standard]) cut event-loop and HTTP
+    # parsing overhead; uvloop is POSIX-only, so fall back on Windows
+    if sys.platform != "win32":
+        loop, http = "uvloop", "httptools"
+    else:
+        loop, http = "auto", "auto"
+
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=port,
         reload=False,
-        log_level="info"
+        log_level="info",
+        loop=loop,
+        http=http
     )
 
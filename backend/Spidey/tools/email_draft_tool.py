@@ -1,11 +1,13 @@
 """
-Email Draft Tool - Exact implementation from test.py
+Email Draft Tool - Create drafts via the email management service
 """
 
 import logging
 import requests
 from langchain.tools import tool
 import os
+
+from utils.helpers import parse_json_response
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -18,8 +20,15 @@ BASE_API_URL = os.getenv(
 # API URL for creating drafts
 API_URL = BASE_API_URL + "/create-multi-draft"
 
+# Shared session so repeated tool calls reuse pooled TCP connections
+# instead of paying a new TLS handshake per call
+_session = requests.Session()
+
+# Bound every backend call so a hung connection fails fast instead of
+# blocking the agent turn indefinitely
+_REQUEST_TIMEOUT = 30
+
 
-# Tool definition - exact from test.py
 @tool
 def create_email_drafts(user_email: str, drafts: list) -> dict:
     """
@@ -40,10 +49,10 @@ def create_email_drafts(user_email: str, drafts: list) -> dict:
         "Content-Type": "application/json"
     }
 
-    logger.info(f"→ Calling {API_URL} with payload: {payload}")
-    response = requests.post(API_URL, json=payload, headers=headers)
+    logger.info(f"Calling {API_URL} with payload: {payload}")
+    response = _session.post(API_URL, json=payload, headers=headers, timeout=_REQUEST_TIMEOUT)
     response.raise_for_status()
-    return response.json()
+    return parse_json_response(response)
 
 
 __all__ = ['create_email_drafts']
@@ -7,6 +7,8 @@ import requests
 from langchain.tools import tool
 import os
 
+from utils.helpers import parse_json_response
+
 # Configure logging
 logger = logging.getLogger(__name__)
 
@@ -16,6 +18,14 @@ BASE_API_URL = os.getenv(
     "https://superspidey-email-management.onrender.com"
 )
 
+# Shared session so repeated tool calls reuse pooled TCP connections
+# instead of paying a new TLS handshake per call
+_session = requests.Session()
+
+# Bound every backend call so a hung connection fails fast instead of
+# blocking the agent turn indefinitely
+_REQUEST_TIMEOUT = 30
+
 
 # Tool for fetching paginated emails
 @tool
@@ -37,12 +47,12 @@ def fetch_emails_page(user_email: str, page: int = 1) -> dict:
         "page": page
     }
 
-    logger.info(f"→ Calling {api_url} with params: {params}")
+    logger.info(f"Calling {api_url} with params: {params}")
 
     try:
-        response = requests.get(api_url, params=params)
+        response = _session.get(api_url, params=params, timeout=_REQUEST_TIMEOUT)
         response.raise_for_status()
-        data = response.json()
+        data = parse_json_response(response)
 
         # Log what we got back
         total_count = data.get('total_count', 0)
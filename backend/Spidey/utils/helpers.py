@@ -6,8 +6,18 @@ import re
 import logging
 from typing import Any, Dict, Optional
 
+# orjson is a C-accelerated JSON parser; fall back to stdlib when missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# Compiled once at import time - both run on every request
+_EMAIL_VALIDATE_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_EMAIL_EXTRACT_RE = re.compile(r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b')
+
 
 def validate_email(email: str) -> bool:
     """
@@ -22,9 +32,7 @@ def validate_email(email: str) -> bool:
     if not email or not isinstance(email, str):
         return False
     
-    # Basic email regex pattern
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return bool(re.match(pattern, email))
+    return bool(_EMAIL_VALIDATE_RE.match(email))
 
 
 def format_email_response(response_data: Dict[str, Any]) -> str:
@@ -42,16 +50,11 @@ def format_email_response(response_data: Dict[str, Any]) -> str:
     
     if response_data.get("success") is False:
         error = response_data.get("error", "Unknown error")
-        return f"❌ Sorry, something went wrong: {error}"
-    
-    response = response_data.get("response", "")
-    
-    # If the response already has formatting, return as-is
-    if "✅" in response or "❌" in response or "📝" in response:
-        return response
-    
-    # Otherwise, add some friendly formatting
-    return f"💬 {response}"
+        return f"Sorry, something went wrong: {error}"
+
+    # Plain ASCII only - the system prompt forbids emojis, and emoji-free
+    # responses keep token counts and cache keys stable
+    return response_data.get("response", "")
 
 
 def sanitize_input(text: str, max_length: int = 5000) -> str:
@@ -92,11 +95,15 @@ def extract_email_addresses(text: str) -> list:
     if not text:
         return []
     
-    # Email regex pattern
-    pattern = r'\b[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\b'
-    emails = re.findall(pattern, text)
-    
-    return list(set(emails))  # Remove duplicates
+    # Dedupe in one pass, preserving first-seen order
+    seen = set()
+    emails = []
+    for email in _EMAIL_EXTRACT_RE.findall(text):
+        if email not in seen:
+            seen.add(email)
+            emails.append(email)
+
+    return emails
 
 
 def truncate_text(text: str, max_length: int = 100, suffix: str = "...") -> str:
@@ -117,6 +124,21 @@ def truncate_text(text: str, max_length: int = 100, suffix: str = "...") -> str:
     return text[:max_length - len(suffix)].strip() + suffix
 
 
+def parse_json_response(response) -> Any:
+    """
+    Decode the JSON body of a requests.Response.
+
+    Args:
+        response: Response object with a JSON body
+
+    Returns:
+        Decoded Python object
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+
 def parse_conversation_history(history: str) -> list:
     """
     Parse conversation history into a list of messages.
@@ -132,10 +154,8 @@ def parse_conversation_history(history: str) -> list:
     
     messages = []
     
-    # Simple parsing - split by common delimiters
-    lines = history.split('\n')
-    
-    for line in lines:
+    # Simple parsing - splitlines handles \n, \r\n and friends in one C pass
+    for line in history.splitlines():
         line = line.strip()
         if not line:
             continue
@@ -167,6 +187,7 @@ __all__ = [
     'sanitize_input',
     'extract_email_addresses',
     'truncate_text',
+    'parse_json_response',
     'parse_conversation_history'
 ]
 